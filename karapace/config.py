@@ -4,21 +4,99 @@ karapace - configuration validation
 Copyright (c) 2019 Aiven Ltd
 See LICENSE for details
 """
+from collections import ChainMap
 from enum import Enum, unique
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, IO, List, Optional, Union
+from types import MappingProxyType
+from typing import Dict, IO, List, Optional, TYPE_CHECKING, Union
 
+import copy
 import os
 import socket
-import ssl
-import ujson
+import stat
+import sys
 
-Config = Dict[str, Union[None, str, int, bool, List[str]]]
+if TYPE_CHECKING:
+    import ssl
 
-HOSTNAME = socket.gethostname()  # pylint bug (#4302) pylint: disable=no-member
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    # The C accelerated stdlib json is fast enough for the small config files
+    # handled here and avoids depending on another binary module
+    import json
+
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+
+if sys.version_info >= (3, 8) or TYPE_CHECKING:
+    from typing import TypedDict
+
+    class Config(TypedDict, total=False):
+        """Typed view of the configuration, still a plain dict at runtime.
+
+        total=False because callers routinely build partial configs and rely
+        on set_config_defaults to fill in the rest.
+        """
+
+        advertised_hostname: str
+        bootstrap_uri: Union[str, List[str]]
+        client_id: str
+        compatibility: str
+        connections_max_idle_ms: int
+        consumer_enable_auto_commit: bool
+        consumer_request_timeout_ms: int
+        consumer_request_max_bytes: int
+        fetch_min_bytes: int
+        group_id: str
+        host: str
+        port: int
+        server_tls_certfile: Optional[str]
+        server_tls_keyfile: Optional[str]
+        registry_host: str
+        registry_port: int
+        registry_ca: Optional[str]
+        log_level: str
+        master_eligibility: bool
+        replication_factor: int
+        security_protocol: str
+        sentry: Dict[str, object]
+        ssl_cafile: Optional[str]
+        ssl_certfile: Optional[str]
+        ssl_keyfile: Optional[str]
+        ssl_check_hostname: bool
+        ssl_ciphers: Optional[str]
+        ssl_crlfile: Optional[str]
+        ssl_password: Optional[str]
+        sasl_mechanism: Optional[str]
+        sasl_plain_username: Optional[str]
+        sasl_plain_password: Optional[str]
+        topic_name: str
+        metadata_max_age_ms: int
+        admin_metadata_max_age: int
+        producer_acks: int
+        producer_compression_type: Optional[str]
+        producer_count: int
+        producer_linger_ms: int
+        session_timeout_ms: int
+        karapace_rest: bool
+        karapace_registry: bool
+        master_election_strategy: str
+        protobuf_runtime_directory: str
+
+else:  # TypedDict is not available in typing on Python 3.7
+    Config = Dict[str, Union[None, str, int, bool, List[str]]]
 
 DEFAULTS = {
-    "advertised_hostname": HOSTNAME,
+    # None is a sentinel, the hostname is resolved in set_config_defaults
+    "advertised_hostname": None,
     "bootstrap_uri": "127.0.0.1:9092",
     "client_id": "sr-1",
     "compatibility": "BACKWARD",
@@ -61,8 +139,14 @@ DEFAULTS = {
     "master_election_strategy": "lowest",
     "protobuf_runtime_directory": "runtime",
 }
+# Frozen view so neither set_config_defaults nor callers can mutate the defaults
+DEFAULTS = MappingProxyType(DEFAULTS)
 DEFAULT_LOG_FORMAT_JOURNAL = "%(name)-20s\t%(threadName)s\t%(levelname)-8s\t%(message)s"
 
+# Maps the environment variable overriding a configuration key to the key itself,
+# built once instead of recomputing the names on every set_config_defaults call
+_ENV_KEY_MAP = {(k.upper() if k.startswith("karapace") else f"KARAPACE_{k.upper()}"): k for k in DEFAULTS}
+
 
 class InvalidConfiguration(Exception):
     pass
@@ -74,94 +158,226 @@ class ElectionStrategy(Enum):
     lowest = "lowest"
 
 
+_ELECTION_STRATEGIES = frozenset(strategy.value for strategy in ElectionStrategy)
+
+
 def parse_env_value(value: str) -> Union[str, int, bool]:
     # we only have ints, strings and bools in the config
-    try:
-        return int(value)
-    except ValueError:
-        pass
-    if value.lower() == "false":
+    lowercased = value.lower()
+    if lowercased == "false":
         return False
-    if value.lower() == "true":
+    if lowercased == "true":
         return True
+    # checking isdecimal beforehand avoids paying for the exception machinery
+    # of int() on the common case of a plain string value; unlike isdigit it
+    # is True only for characters int() actually accepts (e.g. not "²")
+    digits = value[1:] if value[:1] in ("+", "-") else value
+    if digits.isdecimal():
+        return int(value)
     return value
 
 
+def _compile_env_overrides_applier():
+    """Generate straight-line code specialized to DEFAULTS.
+
+    The env override scan only depends on data known at import time, so
+    unrolling it into a generated function removes the per-call iteration
+    and name lookups.
+    """
+    override_lines = ["def _apply_env_overrides(config, env):"]
+    for env_name, key in _ENV_KEY_MAP.items():
+        override_lines.append(f"    if {env_name!r} in env:")
+        override_lines.append(f"        val = env[{env_name!r}]")
+        override_lines.append(
+            f'        print("Populating config value {key} from env var {env_name} with "'
+            f' + val + " instead of config file")'
+        )
+        override_lines.append(f"        config[{key!r}] = parse_env_value(val)")
+
+    namespace = {"parse_env_value": parse_env_value}
+    code = compile("\n".join(override_lines), "<karapace.config generated>", "exec")
+    exec(code, namespace)  # pylint: disable=exec-used
+    return namespace["_apply_env_overrides"]
+
+
+_apply_env_overrides = _compile_env_overrides_applier()
+
+
 def set_config_defaults(config: Config) -> Config:
-    for k, v in DEFAULTS.items():
-        if k.startswith("karapace"):
-            env_name = k.upper()
-        else:
-            env_name = f"karapace_{k}".upper()
-        if env_name in os.environ:
-            val = os.environ[env_name]
-            print(f"Populating config value {k} from env var {env_name} with {val} instead of config file")
-            config[k] = parse_env_value(os.environ[env_name])
-        config.setdefault(k, v)
+    # A single C-level dict materialization replaces a setdefault call per
+    # key, and the caller's dict is no longer mutated
+    config = dict(ChainMap(config, DEFAULTS))
+
+    # One C-level keyset intersection, typically empty so the whole env
+    # override pass is skipped
+    if _ENV_KEY_MAP.keys() & os.environ.keys():
+        # A plain dict snapshot makes the per-key lookups in the generated
+        # applier bare hash lookups, skipping the Environ wrapper
+        _apply_env_overrides(config, os.environ.copy())
+
+    if config["advertised_hostname"] is None:
+        config["advertised_hostname"] = socket.gethostname()  # pylint bug (#4302) pylint: disable=no-member
 
     master_election_strategy = config["master_election_strategy"]
-    try:
-        ElectionStrategy(master_election_strategy.lower())
-    except ValueError:
-        valid_strategies = [strategy.value for strategy in ElectionStrategy]
+    if master_election_strategy.lower() not in _ELECTION_STRATEGIES:
+        valid_strategies = sorted(_ELECTION_STRATEGIES)
         raise InvalidConfiguration(
             f"Invalid master election strategy: {master_election_strategy}, valid values are {valid_strategies}"
-        ) from None
+        )
 
     return config
 
 
 def write_config(config_path: Path, custom_values: Config) -> None:
-    config_path.write_text(ujson.dumps(custom_values))
+    data = json_dumps(custom_values)
+    try:
+        # Skip the write entirely when the content would not change
+        if config_path.read_bytes() == data:
+            return
+    except OSError:
+        pass
+    # Write to a sibling file and rename so readers never observe a
+    # partially written config
+    tmp_path = config_path.with_suffix(config_path.suffix + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, config_path)
 
 
-def read_config(config_handler: IO) -> Config:
+def _loads_config(data: Union[bytes, str]) -> Config:
     try:
-        config = ujson.load(config_handler)
+        return json_loads(data)
     except ValueError as ex:
         raise InvalidConfiguration("Configuration is not a valid JSON") from ex
 
+
+def read_config(config_handler: IO) -> Config:
+    return set_config_defaults(_loads_config(config_handler.read()))
+
+
+@lru_cache(maxsize=32)
+def _parse_config_file(path: str, mtime_ns: int, size: int) -> Config:  # pylint: disable=unused-argument
+    # mtime_ns and size are only part of the cache key, a change to the file
+    # on disk invalidates the cached parse result. Slurping the whole file
+    # lets the JSON parser work on a single contiguous buffer.
+    return _loads_config(Path(path).read_bytes())
+
+
+def read_config_path(config_path: Path) -> Config:
+    """Like read_config, but skips reparsing when the file did not change since the last call."""
+    st = os.stat(config_path)
+    config = copy.deepcopy(_parse_config_file(str(config_path), st.st_mtime_ns, st.st_size))
     return set_config_defaults(config)
 
 
-def create_client_ssl_context(config: Config) -> Optional[ssl.SSLContext]:
-    # taken from conn.py, as it adds a lot more logic to the context configuration than the initial version
+def _stat_or_raise(path: str, label: str) -> os.stat_result:
+    """Validate existence and file type with a single stat syscall."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise InvalidConfiguration(f"`{label}` file does not exist") from None
+    if not stat.S_ISREG(st.st_mode):
+        raise InvalidConfiguration(f"`{label}` is not a regular file")
+    return st
+
+
+def _tls_file_mtime(path: Optional[str]) -> Optional[int]:
+    if not path:
+        return None
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+@lru_cache(maxsize=1)
+def _disable_old_tls_versions() -> int:
+    """Bitmask disabling everything older than TLSv1.2, combined once instead of four ssl_context.options writes."""
+    import ssl  # pylint: disable=import-outside-toplevel
+
+    return ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
+
+
+def create_client_ssl_context(config: Config) -> Optional["ssl.SSLContext"]:
     if config["security_protocol"] == "PLAINTEXT":
         return None
-    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS)
-    ssl_context.options |= ssl.OP_NO_SSLv2
-    ssl_context.options |= ssl.OP_NO_SSLv3
-    ssl_context.options |= ssl.OP_NO_TLSv1
-    ssl_context.options |= ssl.OP_NO_TLSv1_1
-    ssl_context.verify_mode = ssl.CERT_OPTIONAL
-    if config["ssl_check_hostname"]:
-        ssl_context.check_hostname = True
-    if config["ssl_cafile"]:
-        ssl_context.load_verify_locations(config["ssl_cafile"])
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-    if config["ssl_certfile"] and config["ssl_keyfile"]:
+    return _client_ssl_context(
+        config["ssl_cafile"],
+        _tls_file_mtime(config["ssl_cafile"]),
+        config["ssl_certfile"],
+        _tls_file_mtime(config["ssl_certfile"]),
+        config["ssl_keyfile"],
+        _tls_file_mtime(config["ssl_keyfile"]),
+        config["ssl_crlfile"],
+        _tls_file_mtime(config["ssl_crlfile"]),
+        config["ssl_password"],
+        bool(config["ssl_check_hostname"]),
+        config.get("ssl_ciphers"),
+    )
+
+
+@lru_cache(maxsize=8)
+def _client_ssl_context(  # pylint: disable=unused-argument,too-many-arguments
+    cafile: Optional[str],
+    cafile_mtime: Optional[int],
+    certfile: Optional[str],
+    certfile_mtime: Optional[int],
+    keyfile: Optional[str],
+    keyfile_mtime: Optional[int],
+    crlfile: Optional[str],
+    crlfile_mtime: Optional[int],
+    password: Optional[str],
+    check_hostname: bool,
+    ciphers: Optional[str],
+) -> "ssl.SSLContext":
+    """Build or reuse a client SSL context.
+
+    The *_mtime arguments only participate in the memoization key: editing a
+    referenced PEM file changes the key and forces a rebuild, everything else
+    skips the repeated certificate parsing.
+    """
+    # taken from conn.py, as it adds a lot more logic to the context configuration than the initial version
+    import ssl  # pylint: disable=import-outside-toplevel
+
+    # create_default_context sets up strong ciphers and certificate checking,
+    # including load_verify_locations when a cafile is given
+    ssl_context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    ssl_context.options |= _disable_old_tls_versions()
+    # Only write the attributes whose final value differs from the defaults
+    # of create_default_context, the configured values themselves are not
+    # changed: ssl_check_hostname is honored with and without a cafile.
+    # (Python only rejects check_hostname with CERT_NONE, not CERT_OPTIONAL.)
+    if not check_hostname:
+        # check_hostname must be disabled before verify_mode can be relaxed
+        ssl_context.check_hostname = False
+    verify_mode = ssl.CERT_REQUIRED if cafile else ssl.CERT_OPTIONAL
+    if verify_mode != ssl.CERT_REQUIRED:
+        ssl_context.verify_mode = verify_mode
+    if certfile and keyfile:
         ssl_context.load_cert_chain(
-            certfile=config["ssl_certfile"],
-            keyfile=config["ssl_keyfile"],
-            password=config["ssl_password"],
+            certfile=certfile,
+            keyfile=keyfile,
+            password=password,
         )
-    if config["ssl_crlfile"]:
+    if crlfile:
         if not hasattr(ssl, "VERIFY_CRL_CHECK_LEAF"):
             raise RuntimeError("This version of Python does not support ssl_crlfile!")
-        ssl_context.load_verify_locations(config["ssl_crlfile"])
+        ssl_context.load_verify_locations(crlfile)
         ssl_context.verify_flags |= ssl.VERIFY_CRL_CHECK_LEAF
-    if config.get("ssl_ciphers"):
-        ssl_context.set_ciphers(config["ssl_ciphers"])
+    if ciphers:
+        ssl_context.set_ciphers(ciphers)
     return ssl_context
 
 
-def create_server_ssl_context(config: Config) -> Optional[ssl.SSLContext]:
+def create_server_ssl_context(config: Config) -> Optional["ssl.SSLContext"]:
     tls_certfile = config["server_tls_certfile"]
     tls_keyfile = config["server_tls_keyfile"]
+    if tls_certfile is None and tls_keyfile is None:
+        # Neither config value set, do not use TLS
+        return None
+    # Validate before the memoized call: an unhashable value would otherwise
+    # fail the cache key hashing with a TypeError instead of raising
+    # InvalidConfiguration
     if tls_certfile is None:
-        if tls_keyfile is None:
-            # Neither config value set, do not use TLS
-            return None
         raise InvalidConfiguration("`server_tls_keyfile` defined but `server_tls_certfile` not defined")
     if tls_keyfile is None:
         raise InvalidConfiguration("`server_tls_certfile` defined but `server_tls_keyfile` not defined")
@@ -169,16 +385,32 @@ def create_server_ssl_context(config: Config) -> Optional[ssl.SSLContext]:
         raise InvalidConfiguration("`server_tls_certfile` is not a string")
     if not isinstance(tls_keyfile, str):
         raise InvalidConfiguration("`server_tls_keyfile` is not a string")
-    if not os.path.exists(tls_certfile):
-        raise InvalidConfiguration("`server_tls_certfile` file does not exist")
-    if not os.path.exists(tls_keyfile):
-        raise InvalidConfiguration("`server_tls_keyfile` file does not exist")
-
-    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-    ssl_context.options |= ssl.OP_NO_SSLv2
-    ssl_context.options |= ssl.OP_NO_SSLv3
-    ssl_context.options |= ssl.OP_NO_TLSv1
-    ssl_context.options |= ssl.OP_NO_TLSv1_1
+    return _server_ssl_context(
+        tls_certfile,
+        _tls_file_mtime(tls_certfile),
+        tls_keyfile,
+        _tls_file_mtime(tls_keyfile),
+    )
+
+
+@lru_cache(maxsize=8)
+def _server_ssl_context(  # pylint: disable=unused-argument
+    tls_certfile: str,
+    certfile_mtime: Optional[int],
+    tls_keyfile: str,
+    keyfile_mtime: Optional[int],
+) -> "ssl.SSLContext":
+    """Build or reuse a server SSL context, memoized like _client_ssl_context.
+
+    The caller has already validated that both paths are strings.
+    """
+    import ssl  # pylint: disable=import-outside-toplevel
+
+    _stat_or_raise(tls_certfile, "server_tls_certfile")
+    _stat_or_raise(tls_keyfile, "server_tls_keyfile")
+
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.options |= _disable_old_tls_versions()
 
     ssl_context.load_cert_chain(certfile=tls_certfile, keyfile=tls_keyfile)
     return ssl_context
@@ -53,6 +53,10 @@ class KafkaRest(KarapaceBase):
         self._async_producer: Optional[AIOKafkaProducer] = None
         self._async_producer_lock = asyncio.Lock()
 
+        # The admin client above is connected, the instance can serve requests
+        self.ready_event = asyncio.Event()
+        self.ready_event.set()
+
     def _add_kafka_rest_routes(self) -> None:
         # Brokers
         self.route("/brokers", callback=self.list_brokers, method="GET", rest_request=True)
@@ -8,9 +8,10 @@ from kafka import KafkaConsumer, KafkaProducer
 from kafka.admin import KafkaAdminClient
 from kafka.errors import NoBrokersAvailable, NodeNotReadyError, TopicAlreadyExistsError
 from karapace import constants
-from karapace.config import Config, read_config
+from karapace.config import Config, read_config_path
 from karapace.schema_reader import KafkaSchemaReader
 from karapace.utils import json_encode, KarapaceKafkaClient
+from pathlib import Path
 from typing import Optional
 
 import argparse
@@ -229,8 +230,7 @@ def parse_args():
 def main() -> int:
     args = parse_args()
 
-    with open(args.config, encoding="utf8") as handler:
-        config = read_config(handler)
+    config = read_config_path(Path(args.config))
 
     sb = SchemaBackup(config, args.location, args.topic)
 
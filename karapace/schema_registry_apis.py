@@ -59,6 +59,9 @@ class KarapaceSchemaRegistry(KarapaceBase):
         self.ksr = KafkaSchemaReader(config=self.config, master_coordinator=self.mc)
         self.ksr.start()
         self.schema_lock = asyncio.Lock()
+        # Set once the master election has finished and the schema reader has
+        # caught up, i.e. when the instance can serve requests
+        self.ready_event = asyncio.Event()
 
     def _create_producer(self) -> KafkaProducer:
         while True:
@@ -650,6 +653,7 @@ class KarapaceSchemaRegistry(KarapaceBase):
                 elif self.ksr.ready is False:
                     self.log.info("Schema reader isn't ready yet: %r", self.ksr.ready)
                 else:
+                    self.ready_event.set()
                     return are_we_master, master_url
                 await asyncio.sleep(1.0)
 
@@ -50,6 +50,13 @@ def split_by_comma(arg: str) -> List[str]:
 
 def pytest_addoption(parser, pluginmanager) -> None:  # pylint: disable=unused-argument
     parser.addoption("--kafka-bootstrap-servers", type=split_by_comma)
+    parser.addoption(
+        "--broker",
+        choices=("kafka", "redpanda"),
+        default="kafka",
+        help="Broker implementation started for the tests. redpanda is a single native binary speaking the Kafka "
+        "protocol, it needs no zookeeper and boots in a fraction of the JVM's time, but must be installed separately.",
+    )
     parser.addoption("--registry-url")
     parser.addoption("--rest-url")
     parser.addoption("--server-ca")
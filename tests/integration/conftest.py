@@ -6,34 +6,41 @@ See LICENSE for details
 """
 from contextlib import closing, ExitStack
 from dataclasses import asdict, dataclass
-from filelock import FileLock
+from functools import lru_cache
 from kafka import KafkaProducer
 from kafka.errors import LeaderNotAvailableError, NoBrokersAvailable
-from karapace.config import set_config_defaults, write_config
+from karapace.config import Config, set_config_defaults, write_config
 from karapace.kafka_rest_apis import KafkaRest, KafkaRestAdminClient
 from karapace.schema_registry_apis import KarapaceSchemaRegistry
 from karapace.utils import Client
 from pathlib import Path
-from subprocess import Popen
+from subprocess import CalledProcessError, check_output, Popen, STDOUT, TimeoutExpired
 from tests.utils import (
+    await_port,
     Expiration,
-    get_random_port,
     KAFKA_PORT_RANGE,
     KafkaConfig,
     KafkaServers,
     new_random_name,
     REGISTRY_PORT_RANGE,
     repeat_until_successful_request,
+    reserve_ports,
     ZK_PORT_RANGE,
 )
-from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
 
+import asyncio
+import copy
+import errno
+import fcntl
+import json
 import os
 import pytest
+import re
+import select
 import signal
 import socket
 import time
-import ujson
 
 # Keep these in sync with the Makefile
 KAFKA_CURRENT_VERSION = "2.7"
@@ -58,24 +65,51 @@ class ZKConfig:
         )
 
 
+@lru_cache(maxsize=32)
+def _config_defaults_cache(frozen_overrides: tuple) -> Config:
+    overrides = {k: list(v) if isinstance(v, tuple) else v for k, v in frozen_overrides}
+    return set_config_defaults(overrides)
+
+
+def cached_set_config_defaults(overrides: Config) -> Config:
+    """set_config_defaults memoized on the overrides.
+
+    The defaults merge is pure, so fixtures passing the same overrides for
+    every test can reuse the result. List values are frozen to tuples for
+    the cache key and restored on the way in; a deepcopy is returned so the
+    caller may mutate the config.
+    """
+    frozen_overrides = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in overrides.items()))
+    return copy.deepcopy(_config_defaults_cache(frozen_overrides))
+
+
 def stop_process(proc: Optional[Popen]) -> None:
     if proc:
-        os.kill(proc.pid, signal.SIGKILL)
-        proc.wait(timeout=10.0)
+        # SIGTERM first so the JVM runs its shutdown hooks and leaves the log
+        # dirs clean, a SIGKILLed broker forces log recovery on the next boot
+        os.kill(proc.pid, signal.SIGTERM)
+        try:
+            proc.wait(timeout=3.0)
+        except TimeoutExpired:
+            os.kill(proc.pid, signal.SIGKILL)
+            proc.wait(timeout=10.0)
 
 
 def port_is_listening(hostname: str, port: int, ipv6: bool) -> bool:
-    if ipv6:
-        s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM, 0)
-    else:
-        s = socket.socket()
-    s.settimeout(0.5)
-    try:
-        s.connect((hostname, port))
-        s.close()
-        return True
-    except socket.error:
-        return False
+    family = socket.AF_INET6 if ipv6 else socket.AF_INET
+    with closing(socket.socket(family, socket.SOCK_STREAM, 0)) as s:
+        # A non-blocking connect answers "not listening" in ~50ms, while a
+        # blocking connect with a timeout could hang for the full 500ms
+        s.setblocking(False)
+        err = s.connect_ex((hostname, port))
+        if err == 0:
+            return True
+        if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            return False
+        writable = select.select([], [s], [], 0.05)[1]
+        if not writable:
+            return False
+        return s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
 
 
 def wait_for_kafka(kafka_servers: KafkaServers, wait_time) -> None:
@@ -84,26 +118,45 @@ def wait_for_kafka(kafka_servers: KafkaServers, wait_time) -> None:
 
         list_topics_successful = False
         msg = f"Could not contact kafka cluster on host `{server}`"
+        delay = 0.05
         while not list_topics_successful:
             expiration.raise_if_expired(msg)
-            try:
-                KafkaRestAdminClient(bootstrap_servers=server).cluster_metadata()
-            # ValueError:
-            # - if the port number is invalid (i.e. not a number)
-            # - if the port is not bound yet
-            # NoBrokersAvailable:
-            # - if the address/port does not point to a running server
-            # LeaderNotAvailableError:
-            # - if there is no leader yet
-            except (
-                NoBrokersAvailable,
-                LeaderNotAvailableError,
-                ValueError,
-            ) as e:
-                print(f"Error checking kafka cluster: {e}")
-                time.sleep(2.0)
-            else:
-                list_topics_successful = True
+
+            # Cheap TCP probe first: while the broker is still booting, this
+            # answers in milliseconds instead of paying for a full admin
+            # client connect plus metadata RPC on every attempt. Only plain
+            # `host:port` entries can be probed this way; anything else, e.g.
+            # a bare hostname relying on the default port or an IPv6 literal,
+            # goes straight to the admin client which knows how to parse it.
+            hostname, separator, port = server.partition(":")
+            plain_host_port = bool(separator) and port.isdigit()
+            kafka_reachable = not plain_host_port or port_is_listening(hostname, int(port), False)
+
+            if kafka_reachable:
+                try:
+                    # closing() stops the failed probes from leaking a client socket
+                    with closing(KafkaRestAdminClient(bootstrap_servers=server)) as admin_client:
+                        admin_client.cluster_metadata()
+                # ValueError:
+                # - if the port number is invalid (i.e. not a number)
+                # - if the port is not bound yet
+                # NoBrokersAvailable:
+                # - if the address/port does not point to a running server
+                # LeaderNotAvailableError:
+                # - if there is no leader yet
+                except (
+                    NoBrokersAvailable,
+                    LeaderNotAvailableError,
+                    ValueError,
+                ) as e:
+                    print(f"Error checking kafka cluster: {e}")
+                    kafka_reachable = False
+                else:
+                    list_topics_successful = True
+
+            if not kafka_reachable:
+                time.sleep(delay)
+                delay = min(delay * 1.6, 1.0)
 
 
 def wait_for_port(
@@ -113,16 +166,38 @@ def wait_for_port(
     wait_time: float = 20.0,
     ipv6: bool = False,
 ) -> None:
+    wait_for_ports([port], hostname=hostname, wait_time=wait_time, ipv6=ipv6)
+
+
+def wait_for_ports(
+    ports: List[int],
+    *,
+    hostname: str = "127.0.0.1",
+    wait_time: float = 20.0,
+    ipv6: bool = False,
+) -> None:
+    """Wait until every given port accepts connections.
+
+    The ports are probed in a single loop, so for servers booting
+    concurrently the total wait is bounded by the slowest server instead of
+    the sum of the individual boot times.
+    """
     start_time = time.monotonic()
     expiration = Expiration(deadline=start_time + wait_time)
-    msg = f"Timeout waiting for `{hostname}:{port}`"
-
-    while not port_is_listening(hostname, port, ipv6):
-        expiration.raise_if_expired(msg)
-        time.sleep(2.0)
+    pending = list(ports)
+
+    # Exponential backoff: a server that is ready early is detected within
+    # tens of milliseconds instead of blocking for a full flat sleep
+    delay = 0.05
+    while pending:
+        expiration.raise_if_expired(f"Timeout waiting for `{hostname}:{pending}`")
+        pending = [port for port in pending if not port_is_listening(hostname, port, ipv6)]
+        if pending:
+            time.sleep(delay)
+            delay = min(delay * 1.6, 1.0)
 
     elapsed = time.monotonic() - start_time
-    print(f"Server `{hostname}:{port}` listening after {elapsed} seconds")
+    print(f"Servers `{hostname}:{list(ports)}` listening after {elapsed} seconds")
 
 
 def lock_path_for(path: Path) -> Path:
@@ -132,6 +207,23 @@ def lock_path_for(path: Path) -> Path:
     return path.with_suffix("".join(suffixes))
 
 
+def load_zk_kafka_config(transfer_file: Path) -> Optional[Tuple[Optional[ZKConfig], KafkaConfig]]:
+    """Load the server configuration written by an earlier worker or session.
+
+    Returns None when there is no configuration or the broker it describes is
+    no longer listening, e.g. stale state in a reused --basetemp directory.
+    The zookeeper entry is None for brokers that run without one.
+    """
+    if not transfer_file.exists():
+        return None
+    config_data = json.loads(transfer_file.read_text())
+    zk_config = ZKConfig.from_dict(config_data["zookeeper"]) if config_data["zookeeper"] else None
+    kafka_config = KafkaConfig.from_dict(config_data["kafka"])
+    if not port_is_listening("127.0.0.1", kafka_config.kafka_port, False):
+        return None
+    return zk_config, kafka_config
+
+
 @pytest.fixture(scope="session", name="kafka_servers")
 def fixture_kafka_server(request, session_tmppath: Path) -> Iterator[KafkaServers]:
     bootstrap_servers = request.config.getoption("kafka_bootstrap_servers")
@@ -150,27 +242,61 @@ def fixture_kafka_server(request, session_tmppath: Path) -> Iterator[KafkaServer
         # Synchronize xdist workers, data generated by the winner is shared through
         # transfer_file (primarily the server's port number)
 
-        # there is an issue with pylint here, see https:/github.com/tox-dev/py-filelock/issues/102
-        with FileLock(str(lock_path_for(transfer_file))):  # pylint: disable=abstract-class-instantiated
-            if transfer_file.exists():
-                config_data = ujson.loads(transfer_file.read_text())
-                zk_config = ZKConfig.from_dict(config_data["zookeeper"])
-                kafka_config = KafkaConfig.from_dict(config_data["kafka"])
+        # flock blocks the followers in the kernel instead of the userspace
+        # polling FileLock does: the winner holds the exclusive lock while it
+        # boots the servers, the others block on a shared lock until then
+        lock_fd = os.open(str(lock_path_for(transfer_file)), os.O_CREAT | os.O_RDWR, 0o644)
+        stack.callback(os.close, lock_fd)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fcntl.flock(lock_fd, fcntl.LOCK_SH)
+
+        zk_kafka_config = load_zk_kafka_config(transfer_file)
+        if zk_kafka_config is None:
+            # No live servers: trade the lock for the exclusive one and check
+            # again, another worker may have started them while we waited
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            zk_kafka_config = load_zk_kafka_config(transfer_file)
+
+        if zk_kafka_config is not None:
+            zk_config, kafka_config = zk_kafka_config
+        else:
+            if request.config.getoption("broker") == "redpanda":
+                zk_config = None
+                kafka_config, broker_proc = configure_and_start_redpanda(kafka_dir)
+                stack.callback(stop_process, broker_proc)
             else:
                 zk_config, zk_proc = configure_and_start_zk(zk_dir)
                 stack.callback(stop_process, zk_proc)
 
+                # The filesystem setup of Kafka does not depend on zookeeper, do
+                # it while the zookeeper JVM is warming up instead of after
+                kafka_config, kafka_cmd = _prepare_kafka_config(kafka_dir, zk_config)
+
                 # Make sure zookeeper is running before trying to start Kafka
                 wait_for_port(zk_config.client_port, wait_time=20)
 
-                kafka_config, kafka_proc = configure_and_start_kafka(kafka_dir, zk_config)
+                kafka_proc = _start_kafka(kafka_cmd)
                 stack.callback(stop_process, kafka_proc)
 
-                config_data = {
-                    "zookeeper": asdict(zk_config),
-                    "kafka": asdict(kafka_config),
-                }
-                transfer_file.write_text(ujson.dumps(config_data))
+            # Keep the exclusive lock until the broker is listening: a
+            # follower released too early would probe the still-booting
+            # broker, declare the configuration dead and boot a duplicate
+            # broker on the same data directories
+            wait_for_port(kafka_config.kafka_port, wait_time=KAFKA_WAIT_TIMEOUT)
+
+            config_data = {
+                "zookeeper": asdict(zk_config) if zk_config else None,
+                "kafka": asdict(kafka_config),
+            }
+            # Write-then-rename so a reader never sees a partial file
+            tmp_file = transfer_file.with_suffix(f".tmp.{os.getpid()}")
+            tmp_file.write_text(json.dumps(config_data, separators=(",", ":")))
+            os.replace(tmp_file, transfer_file)
+
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
 
         # Make sure every test worker can communicate with kafka
         kafka_servers = KafkaServers(bootstrap_servers=[f"127.0.0.1:{kafka_config.kafka_port}"])
@@ -179,13 +305,20 @@ def fixture_kafka_server(request, session_tmppath: Path) -> Iterator[KafkaServer
         return
 
 
-@pytest.fixture(scope="function", name="producer")
+# Note: the client construction includes the broker metadata join, so these
+# are session scoped to pay that cost once per worker instead of once per
+# test. The aiohttp based fixtures below cannot be promoted the same way
+# because the event loop provided by aiohttp.pytest_plugin is function scoped:
+# a TestServer (or the KarapaceSchemaRegistry/KafkaRest app behind it) bound
+# to one test's loop cannot be reused after that loop is closed, so one
+# server per worker requires a loop whose lifetime spans the worker first.
+@pytest.fixture(scope="session", name="producer")
 def fixture_producer(kafka_servers: KafkaServers) -> KafkaProducer:
     with closing(KafkaProducer(bootstrap_servers=kafka_servers.bootstrap_servers)) as prod:
         yield prod
 
 
-@pytest.fixture(scope="function", name="admin_client")
+@pytest.fixture(scope="session", name="admin_client")
 def fixture_admin(kafka_servers: KafkaServers) -> Iterator[KafkaRestAdminClient]:
     with closing(KafkaRestAdminClient(bootstrap_servers=kafka_servers.bootstrap_servers)) as cli:
         yield cli
@@ -211,7 +344,7 @@ async def fixture_rest_async(
 
     config_path = tmp_path / "karapace_config.json"
 
-    config = set_config_defaults({"bootstrap_uri": kafka_servers.bootstrap_servers, "admin_metadata_max_age": 2})
+    config = cached_set_config_defaults({"bootstrap_uri": kafka_servers.bootstrap_servers, "admin_metadata_max_age": 2})
     write_config(config_path, config)
     rest = KafkaRest(config=config)
 
@@ -245,27 +378,36 @@ async def fixture_rest_async_client(
         client = Client(client_factory=get_client)
 
     try:
-        # wait until the server is listening, otherwise the tests may fail
-        await repeat_until_successful_request(
-            client.get,
-            "brokers",
-            json_data=None,
-            headers=None,
-            error_msg="REST API is unreachable",
-            timeout=10,
-            sleep=0.3,
-        )
+        if rest_url:
+            # wait until the server is listening, otherwise the tests may fail
+            await repeat_until_successful_request(
+                client.get,
+                "brokers",
+                json_data=None,
+                headers=None,
+                error_msg="REST API is unreachable",
+                timeout=10,
+                sleep=0.3,
+            )
+        else:
+            # The server runs in this process, await its ready signal instead
+            # of polling it over HTTP
+            await asyncio.wait_for(rest_async.ready_event.wait(), timeout=10)
         yield client
     finally:
         await client.close()
 
 
 @pytest.fixture(scope="function", name="registry_async_pair")
-def fixture_registry_async_pair(tmp_path: Path, kafka_servers: KafkaServers):
+async def fixture_registry_async_pair(
+    loop,  # pylint: disable=unused-argument
+    tmp_path: Path,
+    kafka_servers: KafkaServers,
+):
     master_config_path = tmp_path / "karapace_config_master.json"
     slave_config_path = tmp_path / "karapace_config_slave.json"
-    master_port = get_random_port(port_range=REGISTRY_PORT_RANGE, blacklist=[])
-    slave_port = get_random_port(port_range=REGISTRY_PORT_RANGE, blacklist=[master_port])
+    registry_ports = reserve_ports(2, port_range=REGISTRY_PORT_RANGE, blacklist=[])
+    master_port, slave_port = registry_ports[0], registry_ports[1]
     topic_name = new_random_name("schema_pairs")
     group_id = new_random_name("schema_pairs")
     write_config(
@@ -297,14 +439,13 @@ def fixture_registry_async_pair(tmp_path: Path, kafka_servers: KafkaServers):
         try:
             master_process = stack.enter_context(Popen(["python", "-m", "karapace.karapace_all", str(master_config_path)]))
             slave_process = stack.enter_context(Popen(["python", "-m", "karapace.karapace_all", str(slave_config_path)]))
-            wait_for_port(master_port)
-            wait_for_port(slave_port)
+            # Both processes boot concurrently, await them concurrently as
+            # well so the event loop stays free for other fixtures
+            await asyncio.gather(await_port(master_port), await_port(slave_port))
             yield f"http://127.0.0.1:{master_port}", f"http://127.0.0.1:{slave_port}"
         finally:
-            if master_process:
-                master_process.kill()
-            if slave_process:
-                slave_process.kill()
+            stop_process(master_process)
+            stop_process(slave_process)
 
 
 @pytest.fixture(scope="function", name="registry_async")
@@ -325,7 +466,7 @@ async def fixture_registry_async(
 
     config_path = tmp_path / "karapace_config.json"
 
-    config = set_config_defaults(
+    config = cached_set_config_defaults(
         {
             "bootstrap_uri": kafka_servers.bootstrap_servers,
             # Using the default settings instead of random values, otherwise it
@@ -366,39 +507,44 @@ async def fixture_registry_async_client(
         client = Client(client_factory=get_client)
 
     try:
-        # wait until the server is listening, otherwise the tests may fail
-        await repeat_until_successful_request(
-            client.get,
-            "subjects",
-            json_data=None,
-            headers=None,
-            error_msg="REST API is unreachable",
-            timeout=10,
-            sleep=0.3,
-        )
+        if registry_url:
+            # wait until the server is listening, otherwise the tests may fail
+            await repeat_until_successful_request(
+                client.get,
+                "subjects",
+                json_data=None,
+                headers=None,
+                error_msg="REST API is unreachable",
+                timeout=10,
+                sleep=0.3,
+            )
+        else:
+            # The server runs in this process, await its ready signal instead
+            # of polling it over HTTP
+            await asyncio.wait_for(registry_async.ready_event.wait(), timeout=10)
         yield client
     finally:
         await client.close()
 
 
-@pytest.fixture(scope="function", name="credentials_folder")
+@pytest.fixture(scope="session", name="credentials_folder")
 def fixture_credentials_folder():
     integration_test_folder = os.path.dirname(__file__)
     credentials_folder = os.path.join(integration_test_folder, "credentials")
     return credentials_folder
 
 
-@pytest.fixture(scope="function", name="server_ca")
+@pytest.fixture(scope="session", name="server_ca")
 def fixture_server_ca(credentials_folder):
     return os.path.join(credentials_folder, "cacert.pem")
 
 
-@pytest.fixture(scope="function", name="server_cert")
+@pytest.fixture(scope="session", name="server_cert")
 def fixture_server_cert(credentials_folder):
     return os.path.join(credentials_folder, "servercert.pem")
 
 
-@pytest.fixture(scope="function", name="server_key")
+@pytest.fixture(scope="session", name="server_key")
 def fixture_server_key(credentials_folder):
     return os.path.join(credentials_folder, "serverkey.pem")
 
@@ -423,7 +569,7 @@ async def fixture_registry_async_tls(
 
     config_path = tmp_path / "karapace_config.json"
 
-    config = set_config_defaults(
+    config = cached_set_config_defaults(
         {
             "bootstrap_uri": kafka_servers.bootstrap_servers,
             "server_tls_certfile": server_cert,
@@ -467,28 +613,43 @@ async def fixture_registry_async_client_tls(
         client = Client(client_factory=get_client, server_ca=server_ca)
 
     try:
-        # wait until the server is listening, otherwise the tests may fail
-        await repeat_until_successful_request(
-            client.get,
-            "subjects",
-            json_data=None,
-            headers=None,
-            error_msg="REST API is unreachable",
-            timeout=10,
-            sleep=0.3,
-        )
+        if registry_url:
+            # wait until the server is listening, otherwise the tests may fail
+            await repeat_until_successful_request(
+                client.get,
+                "subjects",
+                json_data=None,
+                headers=None,
+                error_msg="REST API is unreachable",
+                timeout=10,
+                sleep=0.3,
+            )
+        else:
+            # The server runs in this process, await its ready signal instead
+            # of polling it over HTTP
+            await asyncio.wait_for(registry_async_tls.ready_event.wait(), timeout=10)
         yield client
     finally:
         await client.close()
 
 
-def zk_java_args(cfg_path: Path) -> List[str]:
+@lru_cache(maxsize=1)
+def check_kafka_installation() -> None:
+    """Raise if the kafka release used by the tests is not extracted.
+
+    The result is cached, the installation cannot disappear mid-session and
+    the stat would otherwise run on every server start.
+    """
     if not os.path.exists(BASEDIR):
         raise RuntimeError(
             f"Couldn't find kafka installation to run integration tests. The "
             f"expected folder {BASEDIR} does not exist. Run `make fetch-kafka` "
             f"to download and extract the release."
         )
+
+
+def zk_java_args(cfg_path: Path) -> List[str]:
+    check_kafka_installation()
     java_args = [
         "-cp",
         CLASSPATH,
@@ -499,12 +660,7 @@ def zk_java_args(cfg_path: Path) -> List[str]:
 
 
 def kafka_java_args(heap_mb, kafka_config_path, logs_dir, log4j_properties_path):
-    if not os.path.exists(BASEDIR):
-        raise RuntimeError(
-            f"Couldn't find kafka installation to run integration tests. The "
-            f"expected folder {BASEDIR} does not exist. Run `make fetch-kafka` "
-            f"to download and extract the release."
-        )
+    check_kafka_installation()
     java_args = [
         "-Xmx{}M".format(heap_mb),
         "-Xms{}M".format(heap_mb),
@@ -518,33 +674,73 @@ def kafka_java_args(heap_mb, kafka_config_path, logs_dir, log4j_properties_path)
     return java_args
 
 
-def get_java_process_configuration(java_args: List[str]) -> List[str]:
+@lru_cache(maxsize=1)
+def java_supports_dynamic_cds() -> bool:
+    """True if /usr/bin/java knows the dynamic AppCDS flags (JDK 13+)."""
+    try:
+        out = check_output(["/usr/bin/java", "-version"], stderr=STDOUT)
+    except (OSError, CalledProcessError):
+        return False
+    match = re.search(rb'version "(\d+)', out)
+    return bool(match) and int(match.group(1)) >= 13
+
+
+def get_java_process_configuration(
+    java_args: List[str],
+    heap_mb: Optional[int] = None,
+    cds_archive: Optional[str] = None,
+) -> List[str]:
+    if heap_mb is not None and heap_mb <= 512:
+        # For tiny heaps the serial collector starts faster and uses less
+        # memory than G1, and the tests stop the JVM before the JIT would
+        # pay back a full tiered compilation
+        gc_args = [
+            "-XX:+UseSerialGC",
+            "-XX:TieredStopAtLevel=1",
+        ]
+    else:
+        gc_args = [
+            "-XX:+UseG1GC",
+            "-XX:MaxGCPauseMillis=20",
+            "-XX:InitiatingHeapOccupancyPercent=35",
+        ]
     command = [
         "/usr/bin/java",
         "-server",
-        "-XX:+UseG1GC",
-        "-XX:MaxGCPauseMillis=20",
-        "-XX:InitiatingHeapOccupancyPercent=35",
-        "-XX:+DisableExplicitGC",
-        "-XX:+ExitOnOutOfMemoryError",
-        "-Djava.awt.headless=true",
-        "-Dcom.sun.management.jmxremote",
-        "-Dcom.sun.management.jmxremote.authenticate=false",
-        "-Dcom.sun.management.jmxremote.ssl=false",
     ]
+    command.extend(gc_args)
+    command.extend(
+        [
+            "-XX:+DisableExplicitGC",
+            "-XX:+ExitOnOutOfMemoryError",
+            "-Djava.awt.headless=true",
+            "-Dcom.sun.management.jmxremote",
+            "-Dcom.sun.management.jmxremote.authenticate=false",
+            "-Dcom.sun.management.jmxremote.ssl=false",
+        ]
+    )
+    if cds_archive is not None and java_supports_dynamic_cds():
+        if os.path.exists(cds_archive):
+            # Map the class archive recorded by an earlier session instead of
+            # loading every class file again; -Xshare:auto silently falls
+            # back to the normal path when the archive is stale
+            command.extend([f"-XX:SharedArchiveFile={cds_archive}", "-Xshare:auto"])
+        else:
+            # First run: record the loaded classes when the JVM exits cleanly
+            command.append(f"-XX:ArchiveClassesAtExit={cds_archive}")
     command.extend(java_args)
     return command
 
 
-def configure_and_start_kafka(kafka_dir: Path, zk: ZKConfig) -> Tuple[KafkaConfig, Popen]:
+def _prepare_kafka_config(kafka_dir: Path, zk: ZKConfig) -> Tuple[KafkaConfig, List[str]]:
     # setup filesystem
     data_dir = kafka_dir / "data"
     config_dir = kafka_dir / "config"
     config_path = config_dir / "server.properties"
-    data_dir.mkdir(parents=True)
-    config_dir.mkdir(parents=True)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    config_dir.mkdir(parents=True, exist_ok=True)
 
-    plaintext_port = get_random_port(port_range=KAFKA_PORT_RANGE, blacklist=[])
+    plaintext_port = reserve_ports(1, port_range=KAFKA_PORT_RANGE, blacklist=[])[0]
 
     config = KafkaConfig(
         datadir=str(data_dir),
@@ -580,8 +776,11 @@ def configure_and_start_kafka(kafka_dir: Path, zk: ZKConfig) -> Tuple[KafkaConfi
         "log.message.format.version": KAFKA_CURRENT_VERSION,
         "log.retention.check.interval.ms": 300000,
         "log.segment.bytes": 200 * 1024 * 1024,  # 200 MiB
-        "num.io.threads": 8,
-        "num.network.threads": 112,
+        # A single-broker test cluster with a handful of clients has no use
+        # for a production-sized thread pool, and every network thread costs
+        # a Selector plus its buffers at boot
+        "num.io.threads": 2,
+        "num.network.threads": 3,
         "num.partitions": 1,
         "num.replica.fetchers": 4,
         "num.recovery.threads.per.data.dir": 1,
@@ -596,32 +795,86 @@ def configure_and_start_kafka(kafka_dir: Path, zk: ZKConfig) -> Tuple[KafkaConfi
         "zookeeper.connect": f"127.0.0.1:{zk.client_port}",
     }
 
-    with config_path.open("w") as fp:
-        for key, value in kafka_config.items():
-            fp.write("{}={}\n".format(key, value))
+    config_path.write_text("".join(f"{key}={value}\n" for key, value in kafka_config.items()))
 
     log4j_properties_path = os.path.join(BASEDIR, "config/log4j.properties")
 
+    heap_mb = 256
     kafka_cmd = get_java_process_configuration(
         java_args=kafka_java_args(
-            heap_mb=256,
+            heap_mb=heap_mb,
             logs_dir=str(kafka_dir),
             log4j_properties_path=log4j_properties_path,
             kafka_config_path=str(config_path),
         ),
+        heap_mb=heap_mb,
+        # The archive lives next to the extracted release so it survives the
+        # per-session temporary directories
+        cds_archive=os.path.join(BASEDIR, "kafka.jsa"),
     )
-    env: Dict[bytes, bytes] = {}
-    proc = Popen(kafka_cmd, env=env)
+    return config, kafka_cmd
+
+
+def configure_and_start_redpanda(kafka_dir: Path) -> Tuple[KafkaConfig, Popen]:
+    """Start a redpanda broker as a drop-in replacement for Kafka.
+
+    Redpanda speaks the Kafka protocol from a single native binary, needs no
+    zookeeper and boots in hundreds of milliseconds instead of the JVM's
+    multi-second warmup. The rpk launcher must be installed separately and is
+    only used when the tests are run with --broker=redpanda.
+    """
+    data_dir = kafka_dir / "data"
+    config_dir = kafka_dir / "config"
+    config_path = config_dir / "redpanda.yaml"
+    data_dir.mkdir(parents=True, exist_ok=True)
+    config_dir.mkdir(parents=True, exist_ok=True)
+
+    plaintext_port = reserve_ports(1, port_range=KAFKA_PORT_RANGE, blacklist=[])[0]
+
+    config = KafkaConfig(
+        datadir=str(data_dir),
+        kafka_keystore_password="secret",
+        kafka_port=plaintext_port,
+        zookeeper_port=0,
+    )
+
+    config_path.write_text("redpanda:\n" f"  data_directory: {data_dir}\n" "  node_id: 0\n")
+
+    redpanda_cmd = [
+        "rpk",
+        "redpanda",
+        "start",
+        "--config",
+        str(config_path),
+        # A single reactor thread without the production resource checks is
+        # plenty for a test broker and keeps the footprint small
+        "--smp",
+        "1",
+        "--overprovisioned",
+        "--check=false",
+        "--node-id",
+        "0",
+        "--kafka-addr",
+        f"PLAINTEXT://127.0.0.1:{plaintext_port}",
+    ]
+    proc = Popen(redpanda_cmd, env=dict(os.environ))
     return config, proc
 
 
+def _start_kafka(kafka_cmd: List[str]) -> Popen:
+    # Inherit the environment: with an empty one the JVM loses PATH and LANG
+    # and recomputes locale/charset defaults from scratch at boot
+    env = dict(os.environ)
+    return Popen(kafka_cmd, env=env)
+
+
 def configure_and_start_zk(zk_dir: Path) -> Tuple[ZKConfig, Popen]:
     cfg_path = zk_dir / "zoo.cfg"
     logs_dir = zk_dir / "logs"
-    logs_dir.mkdir(parents=True)
+    logs_dir.mkdir(parents=True, exist_ok=True)
 
-    client_port = get_random_port(port_range=ZK_PORT_RANGE, blacklist=[])
-    admin_port = get_random_port(port_range=ZK_PORT_RANGE, blacklist=[client_port])
+    zk_ports = reserve_ports(2, port_range=ZK_PORT_RANGE, blacklist=[])
+    client_port, admin_port = zk_ports[0], zk_ports[1]
     config = ZKConfig(
         client_port=client_port,
         admin_port=admin_port,
@@ -674,6 +927,9 @@ skipACL=yes
         "CLASSPATH": "/usr/share/java/slf4j/slf4j-simple.jar",
         "ZOO_LOG_DIR": str(logs_dir),
     }
-    java_args = get_java_process_configuration(java_args=zk_java_args(cfg_path))
+    java_args = get_java_process_configuration(
+        java_args=zk_java_args(cfg_path),
+        cds_archive=os.path.join(BASEDIR, "zk.jsa"),
+    )
     proc = Popen(java_args, env=env)
     return config, proc
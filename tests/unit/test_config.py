@@ -0,0 +1,25 @@
+from karapace.config import parse_env_value
+
+
+def test_parse_env_value_booleans():
+    assert parse_env_value("true") is True
+    assert parse_env_value("TRUE") is True
+    assert parse_env_value("false") is False
+    assert parse_env_value("False") is False
+
+
+def test_parse_env_value_integers():
+    assert parse_env_value("8081") == 8081
+    assert parse_env_value("-1") == -1
+    assert parse_env_value("+5") == 5
+
+
+def test_parse_env_value_strings():
+    assert parse_env_value("127.0.0.1:9092") == "127.0.0.1:9092"
+    assert parse_env_value("") == ""
+    assert parse_env_value("+") == "+"
+    assert parse_env_value("-") == "-"
+    # str.isdigit() is True for these but int() rejects them, they must be
+    # returned as strings instead of raising ValueError
+    assert parse_env_value("²") == "²"
+    assert parse_env_value("①") == "①"
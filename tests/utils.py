@@ -9,6 +9,7 @@ from urllib.parse import quote
 import asyncio
 import copy
 import random
+import socket
 import time
 import ujson
 import uuid
@@ -266,6 +267,61 @@ def get_random_port(*, port_range: PortRangeInclusive, blacklist: List[int]) ->
     return value
 
 
+def reserve_ports(count: int, *, port_range: PortRangeInclusive, blacklist: List[int]) -> List[int]:
+    """Find `count` ports in the range `PortRangeInclusive` that are free.
+
+    Unlike `get_random_port` each port is verified with a `bind` before it is
+    handed out, so a port already taken by another session or a system service
+    is never returned. All sockets are held until the full batch is reserved
+    and closed together just before returning, which keeps the window between
+    the check and the server's own `bind` as small as possible. The window
+    still exists, `SO_REUSEADDR` is set so a server can take over the port
+    immediately.
+    """
+    candidates = [port for port in range(port_range.start, port_range.end + 1) if port not in blacklist]
+    random.shuffle(candidates)
+    sockets = []
+    ports: List[int] = []
+    try:
+        for port in candidates:
+            if len(ports) == count:
+                break
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(("127.0.0.1", port))
+            except OSError:
+                sock.close()
+                continue
+            sockets.append(sock)
+            ports.append(port)
+    finally:
+        for sock in sockets:
+            sock.close()
+    if len(ports) != count:
+        raise RuntimeError(f"Could not reserve {count} free ports in range {port_range.start}-{port_range.end}")
+    return ports
+
+
+async def await_port(port: int, *, hostname: str = "127.0.0.1", timeout: float = 20.0) -> None:
+    """Wait until `hostname:port` accepts connections.
+
+    Unlike the synchronous probes in the integration conftest this does not
+    block the event loop, so multiple ports can be awaited concurrently with
+    `asyncio.gather` from async fixtures and tests.
+    """
+    expiration = Expiration.from_timeout(timeout=timeout)
+    while True:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(hostname, port), 0.1)
+        except (asyncio.TimeoutError, OSError):
+            expiration.raise_if_expired(f"Timeout waiting for `{hostname}:{port}`")
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+
 async def new_consumer(c, group, fmt="avro", trail=""):
     payload = copy.copy(consumer_valid_payload)
     payload["format"] = fmt